@@ -30,14 +30,17 @@
  * - somefile.gif must be under 49,980 bytes (~48 KiB)
  * - The screen will attempt to render it regardless, but it works best with animations that are 96x20 pixels
  * - Ensure your computer is capable of connecting to BLE devices
- * - Also ensure you have installed the bleak and tqdm modules as dependencies
+ * - Also ensure you have installed the bleak, numpy, and tqdm modules as dependencies
 '''
 
 from bleak import BleakClient
 from tqdm import tqdm
 
+import numpy
+
 import argparse
 import asyncio
+import struct
 import sys
 
 # The screen will likely have this BLE address. Ensure it is not paired to any other device before running this script.
@@ -47,114 +50,188 @@ DEVICE_ADDRESS = "ff:24:06:18:41:5f"
 # For whatever reason, this maps to the right BLE handle for binary data sending, although Wireshark sees it as 0x000e
 HANDLE = 0x000d
 
-# The second-to-last byte is a CheckSum8 Modulo 256 of the preceding bytes (see https://www.scadacore.com/tools/programming-calculators/online-checksum-calculator/)
-def checksum_mod256(hex_string):
-	return hex(sum(int(hex_string[i:i+2], 16) for i in range(0, len(hex_string), 2)) % 256).upper()[2:].zfill(2)
+# Constant regions of the packet header, parsed from hex once at import time
+# Every packet header always starts with this
+_HDR_PREFIX = bytes.fromhex("aa55ffff")
 
-# The last byte requires a specific checksum calculation, taking into account all previous bytes
-def calculate_last_byte(hex_string):
-	# Convert the preceding bytes to an array of integers and take their sum
-	data_bytes = [int(hex_string[i:i+2], 16) for i in range(0, len(hex_string) - 2, 2)]
-	total_sum = sum(data_bytes)
+# Always constant, between the first page number and the animation length
+_HDR_MID = bytes.fromhex("c1020901010c01000d01000e0100140301090a11040001000a1207")
 
-	# The last byte is the high byte of the total sum
-	# TODO: Can this and checksum_mod256 be combined somehow?
-	last_byte = total_sum // 256
-	return f"{last_byte:02X}"
+# Seems to always be constant, not sure what it represents
+_HDR_SEP = bytes.fromhex("c4000013")
 
-# This sequence ensures the screen is ready for a new animation to be uploaded
-async def reset_screen():
-	# Sending this byte array tells the screen to delete whatever animation(s) it was currently storing, so they can be overwritten
-	# Technically the screen has the capability to store multiple animations and swap between them, but that went beyond the scope of this proof-of-concept
-	await client.write_gatt_char(HANDLE, bytearray.fromhex("aa55ffff0a000900c102080200ffdc04"), response=False)
-	await asyncio.sleep(0.5)
-	# Sending this gets the screen ready to receive a new animation
-	await client.write_gatt_char(HANDLE, bytearray.fromhex("aa55ffff0a000900c10208020000dd03"), response=False)
-	await asyncio.sleep(0.5)
+# TODO: Figure out how to calculate this byte sequence
+# Has something to do with the length of the payload (81c4 for a full payload, but lower if the payload isn't a full 196 bytes)
+# For now, file_to_chunks is just padding the last payload with 0's, so these bytes will work
+_HDR_TAIL = bytes.fromhex("81c4")
 
-def generate_header(payload, index, animation_length):
-	# The header always starts with this
-	header = "aa55ffff"
+# The checksum contribution of the constant header regions, summed once at import time
+# Only the length, page number, and animation length bytes vary per packet
+_CONST_HDR_SUM = sum(_HDR_PREFIX) + sum(_HDR_MID) + sum(_HDR_SEP) + sum(_HDR_TAIL)
 
-	# This is the byte length, in hex, from the first page number below, until the second-to-last byte
-	# (including the first checksum byte but not the last)
-	# Hex byte length of packet plus 41 (40 bytes preceding, 1 byte trailing included in length calculation)
-	header += hex(int(len(payload)/ 2) + 41)[2:]
+# Precompiled packer for the page number field (big-endian two-byte index plus a trailing 00),
+# so the format string is only parsed once instead of on every call
+_PAGE_NUMBER = struct.Struct(">HB")
 
-	# Page/packet number
-	# 000000, 000100, 000200, 000300, 000400, 000500, 000600, 000700, 000800, 000900, 000a00, 000b00, etc.
-	header += f"{index:04x}00"
+# Fixed commands sent around an upload, also parsed from hex once at import time
+# Tells the screen to delete whatever animation(s) it was currently storing, so they can be overwritten
+_CMD_RESET_DELETE = bytes.fromhex("aa55ffff0a000900c102080200ffdc04")
 
-	# Always constant
-	header += "c1020901010c01000d01000e0100140301090a11040001000a1207"
+# Gets the screen ready to receive a new animation
+_CMD_RESET_READY = bytes.fromhex("aa55ffff0a000900c10208020000dd03")
 
-	# The length of the GIF, in frames, in hex - 0c means 12
-	header += f"{animation_length:02X}"
+# Not really sure what this does (or why it's sent twice), but seems to indicate to the screen that the upload has finished
+_CMD_FINISH = bytes.fromhex("aa55ffff0b000f00c10236030100001404")
 
-	# Page number again
-	# 000000, 000100, 000200, 000300, 000400, 000500, 000600, 000700, 000800, 000900, 000a00, 000b00, etc.
-	header += f"{index:04x}00"
+# The two-byte checksum trailer at the end of every packet, given the sum of the header and payload bytes
+# The first byte is a CheckSum8 Modulo 256 of the preceding bytes (see https://www.scadacore.com/tools/programming-calculators/online-checksum-calculator/)
+# The second byte is the high byte of the same sum (the checksum byte itself is not included)
+def trailer(total_sum):
+	return bytes((total_sum % 256, total_sum // 256 % 256))
+
+# Ask for a larger ATT MTU, so each ~200-byte packet fits in a couple of link-layer fragments
+# instead of ~10 under the default MTU of 23
+# bleak negotiates this automatically on macOS/Windows, but the BlueZ backend needs a nudge
+async def request_larger_mtu():
+	try:
+		# Only present on bleak's BlueZ backend
+		await client._backend._acquire_mtu()
+	except AttributeError:
+		pass
+	except Exception as e:
+		print(f"MTU request failed (continuing with the default): {e}")
+
+	print(f"Negotiated MTU: {client.mtu_size}")
+
+# Ask Linux to use the shortest BLE connection interval the spec allows (7.5 ms)
+# With the credit window, upload speed scales directly with connection events per second,
+# and BlueZ's defaults can be as slow as 50+ ms per interval
+# BlueZ reads these debugfs knobs when setting up a connection, so this runs before connecting
+# It needs root, and on macOS/Windows the OS owns the connection parameters, so any failure
+# just means carrying on with the platform defaults
+def request_faster_connection_interval(adapter="hci0"):
+	# Values are in units of 1.25 ms, so 6 means 7.5 ms
+	for knob in ("conn_min_interval", "conn_max_interval"):
+		try:
+			with open(f"/sys/kernel/debug/bluetooth/{adapter}/{knob}", "w") as file:
+				file.write("6")
+		except OSError:
+			# Not Linux, not root, or no debugfs
+			return
 
-	# Seems to always be constant, not sure what it represents
-	header += "c4000013"
+# This sequence ensures the screen is ready for a new animation to be uploaded
+async def reset_screen():
+	# Technically the screen has the capability to store multiple animations and swap between them, but that went beyond the scope of this proof-of-concept
+	await client.write_gatt_char(HANDLE, _CMD_RESET_DELETE, response=False)
+	await asyncio.sleep(0.5)
+	await client.write_gatt_char(HANDLE, _CMD_RESET_READY, response=False)
+	await asyncio.sleep(0.5)
 
-	# TODO: Figure out how to calculate this byte sequence
-	# Has something to do with the length of the payload (81c4 for a full payload, but lower if the payload isn't a full 196 bytes)
-	# For now, file_to_hex_chunks is just padding the last payload with 0's, so these bytes will work
-	header += "81c4"
-	return header
+def generate_header(payload_len, index, animation_length):
+	# The page/packet number appears twice in the header, as a big-endian two-byte value followed by 00
+	# 000000, 000100, 000200, 000300, 000400, 000500, 000600, 000700, 000800, 000900, 000a00, 000b00, etc.
+	page_number = _PAGE_NUMBER.pack(index, 0)
+
+	return (
+		_HDR_PREFIX
+		# This is the byte length from the first page number, until the second-to-last byte
+		# (including the first checksum byte but not the last)
+		# Byte length of packet plus 41 (40 bytes preceding, 1 byte trailing included in length calculation)
+		+ bytes((payload_len + 41,))
+		+ page_number
+		+ _HDR_MID
+		# The length of the GIF, in frames - 0x0c means 12
+		+ bytes((animation_length,))
+		+ page_number
+		+ _HDR_SEP
+		+ _HDR_TAIL
+	)
 
 # Given a binary payload, the payload index, and the length of the animation (in number of packets)
-# Generate a packet (including a header and four-byte checksum trailer)
-def generate_packet(payload, index, animation_length):
+# Generate a packet (including a header and two-byte checksum trailer)
+# TODO: If uploads ever grow well beyond the current 255-packet limit (say, for multi-animation
+# storage or streaming), the remaining per-packet work here could be compiled with numba.njit
+# writing into a preallocated numpy buffer - not worth a new dependency while the BLE link,
+# not the CPU, is the bottleneck
+def generate_packet(payload, index, animation_length, payload_sum=None):
 	# Header
-	header = generate_header(payload, index, animation_length)
-	full_value = header + payload
-
-	# First two bytes of the checksum trailer
-	checksum = checksum_mod256(full_value)
-	full_value = full_value + checksum
-
-	# Last two bytes of the checksum trailer
-	last_byte = calculate_last_byte(full_value)
-	full_value = full_value + last_byte
-
-	return full_value
+	packet = bytearray(generate_header(len(payload), index, animation_length))
+	packet += payload
+
+	# file_to_chunks precomputes every payload sum in one vectorized pass, but fall back to
+	# summing here in case the caller didn't provide one
+	if payload_sum is None:
+		payload_sum = sum(payload)
+
+	# Two-byte checksum trailer
+	# The constant header regions were summed at import time, so only the variable bytes
+	# (length, page number twice, animation length) and the payload need summing here
+	total_sum = (
+		_CONST_HDR_SUM
+		+ (len(payload) + 41)
+		+ 2 * (index // 256 + index % 256)
+		+ animation_length
+		+ payload_sum
+	)
+	packet += trailer(total_sum)
+
+	return packet
 
 # Split a GIF file into chunks
-def file_to_hex_chunks(filename, chunk_size=392):
+def file_to_chunks(filename, chunk_size=196):
 	try:
 		with open(filename, "rb") as file:
-			hex_string = file.read().hex()
-	except:
-		print("Unable to open GIF file")
+			raw = file.read()
+	except OSError as e:
+		print(f"Unable to open GIF file: {e}")
 		sys.exit(1)
-	
+
 	# Naive GIF file validation
-	if not (hex_string.startswith("GIF87a".encode("ascii").hex()) or hex_string.startswith("GIF89a".encode("ascii").hex())):
+	if raw[:6] not in (b"GIF87a", b"GIF89a"):
 		print(f"{filename} is not a valid GIF file.\n")
 		sys.exit(1)
 
-	hex_chunks = [
-		# TODO: The padding with 0's is currently necessary because the pre-packet byte sequence pattern isn't clear
-		# So at least we can add some 0's, fill up the last packet so it's 196 bytes, and use the default "81c4" value in generate_header
-		hex_string[i:i + chunk_size].ljust(chunk_size, '0')
-		for i in range(0, len(hex_string), chunk_size)
-	]
+	# Pad the file once to a whole number of chunks, then slice it into memoryviews -
+	# zero-copy views into the single padded buffer rather than one copy per chunk
+	# TODO: The padding with 0's is currently necessary because the pre-packet byte sequence pattern isn't clear
+	# So at least we can add some 0's, fill up the last packet so it's 196 bytes, and use the default "81c4" value in generate_header
+	padded = raw.ljust(-(-len(raw) // chunk_size) * chunk_size, b"\x00")
+	view = memoryview(padded)
+	chunks = [view[i:i + chunk_size] for i in range(0, len(padded), chunk_size)]
 
 	# TODO: Not sure if this is a hard limit, but it appears to be given how the length in number of packets seems to be a two-digit hex value
-	if len(hex_chunks) > 255:
+	if len(chunks) > 255:
 		print("Please select a smaller GIF file (under 49,980 bytes or ~48KiB)\n")
 		sys.exit(1)
 
-	return hex_chunks
-
-# Naive BLE notification handling logic
-# Basically just wait for any notification to come in from the device, to trigger the asyncio event
-notification_event = asyncio.Event()
-
-def notification_handler(sender, data):
-	notification_event.set()
+	# Compute every chunk's checksum contribution in one vectorized pass over the file:
+	# with a cumulative sum of the padded bytes, each chunk's sum is just the difference
+	# between two prefix values
+	prefix = numpy.concatenate(([0], numpy.cumsum(numpy.frombuffer(padded, dtype=numpy.uint8), dtype=numpy.int64)))
+	chunk_sums = [int(prefix[(i + 1) * chunk_size] - prefix[i * chunk_size]) for i in range(len(chunks))]
+
+	return chunks, chunk_sums
+
+# Credit-based flow control for the upload loop
+# The screen sends back a "value received" notification for each packet (see misc_notes.md), and
+# appears to be able to buffer a few packets at a time - so instead of a strict write->notify
+# ping-pong, keep up to WINDOW packets in flight, spending a credit per write and earning one
+# back per notification
+WINDOW = 3
+
+# The credits semaphore itself is created inside main(), so it binds to the running event loop
+# (creating asyncio primitives at import time is deprecated on newer Python versions, and this
+# way the module can be imported without side effects)
+def make_notification_handler(credits):
+	def notification_handler(sender, data):
+		# Spurious or duplicate notifications (the reset commands provoke some, and indications come
+		# in through this handler too) must not grow the window beyond WINDOW, or the pipeline could
+		# overflow the screen's input buffer - a BoundedSemaphore raises ValueError when full
+		try:
+			credits.release()
+		except ValueError:
+			pass
+	return notification_handler
 
 async def main():
 	global client
@@ -165,10 +242,49 @@ async def main():
 	args = parser.parse_args()
 
 	GIF_FILE_NAME = args.gif
-	hex_chunks = file_to_hex_chunks(GIF_FILE_NAME)
+	chunks, payload_sums = file_to_chunks(GIF_FILE_NAME)
+
+	# Credit-based flow control for the upload (see the comments above WINDOW)
+	credits = asyncio.BoundedSemaphore(WINDOW)
+	notification_handler = make_notification_handler(credits)
+
+	# Packets are handed from a producer to a consumer through a bounded queue, so packet
+	# construction (headers and checksums) overlaps with the BLE writes instead of happening
+	# in between them - the queue size just keeps the producer a few packets ahead
+	packet_queue = asyncio.Queue(maxsize=8)
+
+	async def produce_packets():
+		for index, chunk in enumerate(chunks):
+			# Build the packet in a worker thread, so the CPU work can run on another core
+			# while the event loop is busy with BLE I/O
+			packet = await asyncio.to_thread(generate_packet, chunk, index, len(chunks), payload_sums[index])
+			await packet_queue.put(packet)
+
+		# Sentinel to tell the consumer the animation is complete
+		await packet_queue.put(None)
+
+	async def send_packets(progress_bar):
+		while True:
+			packet = await packet_queue.get()
+			if packet is None:
+				break
+
+			# Wait for a send credit, so at most WINDOW packets are in flight at once
+			await asyncio.wait_for(credits.acquire(), timeout=0.75)
+
+			# Upload the packet to the screen
+			await client.write_gatt_char(HANDLE, packet, response=False)
+
+			progress_bar.update(1)
+
+	# Ask for the fastest connection interval the platform will give us (Linux only)
+	request_faster_connection_interval()
 
 	async with BleakClient(DEVICE_ADDRESS) as client:
 		if client.is_connected:
+			# Negotiate the MTU up-front, before any notifications or writes
+			await request_larger_mtu()
+
 			try:
 				# Start receiving indications
 				INDICATIONS_UUID="00002a05-0000-1000-8000-00805f9b34fb"
@@ -188,41 +304,31 @@ async def main():
 			await reset_screen()
 		
 			print(f"Connected to {DEVICE_ADDRESS}")
-			print(f"Uploading {GIF_FILE_NAME} (~{len(hex_chunks) * 196} bytes)...\n")
-
-			progress_bar = tqdm(total=len(hex_chunks), desc="Progress", unit=" Packets")
-
-			packet_index = 0
-
-			for hex_chunk in hex_chunks:
-				packet = ""
-				notification_event.clear()
+			print(f"Uploading {GIF_FILE_NAME} (~{len(chunks) * 196} bytes)...\n")
 
-				try:
-					# Generate the binary packet to upload
-					packet = generate_packet(hex_chunk, packet_index, len(hex_chunks))
+			# Rate-limit the progress bar redraws - on a fast link a terminal write per packet
+			# is measurable overhead in the send loop
+			progress_bar = tqdm(total=len(chunks), desc="Progress", unit=" Packets", mininterval=0.2, miniters=8)
 
-					# Upload the packet to the screen
-					await client.write_gatt_char(HANDLE, bytearray.fromhex(packet), response=False)
-
-					# Naively wait for any notification, but it's likely that the notification will be because the current packet was received
-					# TODO: It may be possible to upload more than one packet at a time, and check latest value received notitications so as to not overflow the screen's input buffer
-					# For now, this system works even if it may not be as fast as possible
-					await asyncio.wait_for(notification_event.wait(), timeout=0.75)
-
-					progress_bar.update(1)
-				except Exception as e:
-					print(e)
-					print("An upload error occurred!")
-					sys.exit(1)
-				
-				packet_index += 1
+			try:
+				# Run the packet builder and the BLE sender concurrently
+				await asyncio.gather(produce_packets(), send_packets(progress_bar))
+
+				# Drain the window as a single batch barrier - once all WINDOW credits are back,
+				# every packet has been acknowledged
+				await asyncio.wait_for(
+					asyncio.gather(*(credits.acquire() for _ in range(WINDOW))),
+					timeout=0.75 * WINDOW,
+				)
+			except Exception as e:
+				print(e)
+				print("An upload error occurred!")
+				sys.exit(1)
 			
 			progress_bar.close()
 			
-			# Not really sure what this does (or why it's sent twice), but seems to indicate the the screen that the upload has finished
-			await client.write_gatt_char(HANDLE, bytearray.fromhex("aa55ffff0b000f00c10236030100001404"), response=False)
-			await client.write_gatt_char(HANDLE, bytearray.fromhex("aa55ffff0b000f00c10236030100001404"), response=False)
+			await client.write_gatt_char(HANDLE, _CMD_FINISH, response=False)
+			await client.write_gatt_char(HANDLE, _CMD_FINISH, response=False)
 
 			print("\nUpload successful!")
 
@@ -230,4 +336,5 @@ async def main():
 			print("Failed to connect to the device")
 			sys.exit(1)
 
-asyncio.run(main())
+if __name__ == "__main__":
+	asyncio.run(main())